@@ -0,0 +1,30 @@
+import numpy as np
+
+import torch
+from torch.utils.data import Dataset
+
+
+class IndicesDataset(Dataset):
+    """Dataset of pre-extracted VQVAE codebook indices.
+
+    Loads a single .npy file of shape (N, L) produced by precompute_indices.py,
+    where N is the dataset size and L is the number of tokens per image. The
+    file is memory-mapped, so workers only read the rows they need.
+
+    """
+
+    def __init__(self, indices_path: str, **kwargs):
+        # overriding data.target on the command line merges (not replaces)
+        # data.params, so the image dataset's options (root, img_size, ...)
+        # may still be present; accept and ignore them
+        self.indices_path = indices_path
+        self.indices = np.load(indices_path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, item):
+        # keep the storage dtype (int16) to minimize host-to-device traffic;
+        # the training script widens the indices on the device. np.array
+        # copies the row, since a tensor must not alias the read-only memmap
+        return torch.from_numpy(np.array(self.indices[item]))
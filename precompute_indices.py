@@ -0,0 +1,90 @@
+import argparse
+import numpy as np
+from omegaconf import OmegaConf
+
+import torch
+import accelerate
+from torch.utils.data import DataLoader
+
+from utils.logger import get_logger
+from utils.misc import get_data_generator, instantiate_from_config
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-c', '--config', type=str, required=True,
+        help='Path to transformer training configuration file',
+    )
+    parser.add_argument(
+        '--save_path', type=str, required=True,
+        help='Path to the output .npy file of codebook indices',
+    )
+    parser.add_argument(
+        '--batch_size', type=int, default=256,
+        help='Batch size for the extraction pass',
+    )
+    return parser
+
+
+def main():
+    # PARSE ARGS AND CONFIGS
+    args, unknown_args = get_parser().parse_known_args()
+    unknown_args = [(a[2:] if a.startswith('--') else a) for a in unknown_args]
+    unknown_args = [f'{k}={v}' for k, v in zip(unknown_args[::2], unknown_args[1::2])]
+    conf = OmegaConf.load(args.config)
+    conf = OmegaConf.merge(conf, OmegaConf.from_dotlist(unknown_args))
+
+    # INITIALIZE ACCELERATOR
+    accelerator = accelerate.Accelerator()
+    device = accelerator.device
+    assert accelerator.num_processes == 1, 'precompute_indices.py should be run on a single process'
+
+    # INITIALIZE LOGGER
+    logger = get_logger(use_tqdm_handler=True, is_main_process=accelerator.is_main_process)
+
+    # BUILD DATASET & DATALOADER
+    # note: the dataset's transform is applied as-is, so random augmentations
+    # (e.g. horizontal flip) are baked into the cached indices; override
+    # --data.params.xxx to disable them if that matters for your config
+    dataset = instantiate_from_config(conf.data)
+    dataloader = DataLoader(
+        dataset=dataset, batch_size=args.batch_size,
+        shuffle=False, drop_last=False, **conf.dataloader,
+    )
+    logger.info(f'Size of dataset: {len(dataset)}')
+
+    # LOAD PRETRAINED VQVAE
+    vqvae = instantiate_from_config(conf.vqvae).requires_grad_(False).eval()
+    weights = torch.load(conf.vqvae.pretrained, map_location='cpu', mmap=True)
+    vqvae.load_state_dict(weights['model'])
+    vqvae.to(device)
+    logger.info(f'Successfully load pretrained VQVAE from {conf.vqvae.pretrained}')
+
+    def _discard_labels(x):
+        return x[0] if isinstance(x, (tuple, list)) else x
+
+    # EXTRACT INDICES
+    assert conf.vqvae.params.codebook_num <= 2 ** 15, 'codebook indices do not fit in int16'
+    fm_size = conf.data.params.img_size // 4
+    out = np.lib.format.open_memmap(
+        args.save_path, mode='w+', dtype=np.int16, shape=(len(dataset), fm_size ** 2),
+    )
+    logger.info('Start extracting indices...')
+    cnt = 0
+    data_generator = get_data_generator(dataloader, tqdm_kwargs=dict(desc='Extracting', leave=False))
+    for _ in range(len(dataloader)):
+        batch = next(data_generator)
+        x = _discard_labels(batch).float().to(device)
+        with torch.inference_mode():
+            idx = vqvae.get_latents(x)['indices']                       # (B * H * W)
+        idx = idx.reshape(x.shape[0], -1).to(torch.int16).cpu()        # (B, H * W)
+        out[cnt:cnt+x.shape[0]] = idx.numpy()
+        cnt += x.shape[0]
+    out.flush()
+    logger.info(f'Indices of shape {out.shape} are saved to {args.save_path}')
+    logger.info('End of extraction')
+
+
+if __name__ == '__main__':
+    main()
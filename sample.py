@@ -84,10 +84,10 @@ def main():
 
     # LOAD WEIGHTS
     logger.info('=' * 19 + ' Model Info ' + '=' * 19)
-    ckpt = torch.load(args.vqvae_weights, map_location='cpu')
+    ckpt = torch.load(args.vqvae_weights, map_location='cpu', mmap=True)
     vqvae.load_state_dict(ckpt['model'])
     logger.info(f'Successfully load vqvae from {args.vqvae_weights}')
-    ckpt = torch.load(args.transformer_weights, map_location='cpu')
+    ckpt = torch.load(args.transformer_weights, map_location='cpu', mmap=True)
     transformer.load_state_dict(ckpt['model'])
     logger.info(f'Successfully load transformer from {args.transformer_weights}')
     logger.info('=' * 50)
@@ -1,15 +1,19 @@
 import os
 import argparse
+import threading
 from omegaconf import OmegaConf
 
 import torch
 import accelerate
+from accelerate.utils import GradientAccumulationPlugin
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
 from torchvision.utils import save_image
 
+from datasets.indices import IndicesDataset
 from utils.logger import StatusTracker, get_logger
 from utils.misc import get_time_str, check_freq, get_data_generator
+from utils.misc import ThreadDataPrefetcher, CudaDataPrefetcher
 from utils.misc import create_exp_dir, find_resume_checkpoint, instantiate_from_config
 
 
@@ -44,13 +48,37 @@ def main():
     unknown_args = [f'{k}={v}' for k, v in zip(unknown_args[::2], unknown_args[1::2])]
     conf = OmegaConf.load(args.config)
     conf = OmegaConf.merge(conf, OmegaConf.from_dotlist(unknown_args))
+    # pinned host memory lets H2D copies run asynchronously and overlap compute
+    conf.dataloader.pin_memory = True
+    if conf.dataloader.get('num_workers', 0) > 0:
+        conf.dataloader.persistent_workers = True
 
     # INITIALIZE ACCELERATOR
-    accelerator = accelerate.Accelerator()
+    # accelerator.accumulate below relies on this to skip the DDP gradient
+    # all-reduce (no_sync) on non-final micro-steps; sync_with_dataloader is
+    # disabled because the prefetcher iterates the dataloader ahead of the
+    # batch being trained on, so epoch ends must not force a sync
+    accelerator = accelerate.Accelerator(
+        gradient_accumulation_plugin=GradientAccumulationPlugin(
+            num_steps=conf.train.get('gradient_accumulation_steps', 1),
+            sync_with_dataloader=False,
+        ),
+    )
     device = accelerator.device
     print(f'Process {accelerator.process_index} using device: {device}')
     accelerator.wait_for_everyone()
 
+    # SET PERFORMANCE FLAGS
+    # TF32 matmuls lose no accuracy that matters here, and a larger dynamo cache
+    # avoids recompilations when the compiled model sees new guard combinations
+    torch._dynamo.config.cache_size_limit = 128
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
+    # all shapes are fixed (drop_last=True, constant sequence length), so
+    # cuDNN autotuning settles on the fastest algorithms once
+    torch.backends.cudnn.benchmark = True
+
     # CREATE EXPERIMENT DIRECTORY
     exp_dir = args.exp_dir
     if accelerator.is_main_process:
@@ -94,6 +122,9 @@ def main():
             f'get {conf.train.batch_size} % {accelerator.num_processes} != 0'
         )
     train_set = instantiate_from_config(conf.data)
+    # when training on indices cached by precompute_indices.py, the VQVAE
+    # encoder is skipped entirely in run_step
+    use_cached_indices = isinstance(train_set, IndicesDataset)
     batch_size_per_process = conf.train.batch_size // accelerator.num_processes
     train_loader = DataLoader(
         dataset=train_set, batch_size=batch_size_per_process,
@@ -106,42 +137,90 @@ def main():
 
     # LOAD PRETRAINED VQVAE
     vqvae = instantiate_from_config(conf.vqvae).requires_grad_(False).eval()
-    weights = torch.load(conf.vqvae.pretrained, map_location='cpu')
+    weights = torch.load(conf.vqvae.pretrained, map_location='cpu', mmap=True)
     vqvae.load_state_dict(weights['model'])
     vqvae.to(device)
+    # the frozen encoder runs an identical graph every step (fixed batch shape,
+    # no gradients), so compilation cost is paid exactly once
+    vqvae.get_latents = torch.compile(vqvae.get_latents, mode='reduce-overhead', dynamic=False)
     logger.info('=' * 19 + ' Model Info ' + '=' * 19)
     logger.info(f'Successfully load pretrained VQVAE from {conf.vqvae.pretrained}')
     logger.info('=' * 50)
 
     # BUILD MODEL AND OPTIMIZERS
     model = instantiate_from_config(conf.model)
-    optimizer = instantiate_from_config(conf.train.optim, params=model.parameters())
+    model.to(device)  # fused optimizers require parameters on the device at construction
+    # fused (single kernel) or foreach (batched kernels) update variants avoid
+    # a python-driven loop over parameters; fall back if the configured
+    # optimizer does not support them
+    params = list(model.parameters())  # a failed attempt would exhaust a generator
+    optimizer = None
+    optim_extra_params = [dict(fused=True)] if device.type == 'cuda' else []
+    optim_extra_params += [dict(foreach=True)]
+    for extra_params in optim_extra_params:
+        try:
+            optimizer = instantiate_from_config(conf.train.optim, params=params, **extra_params)
+            break
+        except (TypeError, ValueError, RuntimeError):
+            continue
+    if optimizer is None:
+        # plain construction runs outside any try so genuine config errors surface
+        optimizer = instantiate_from_config(conf.train.optim, params=params)
     step = 0
 
     def load_ckpt(ckpt_path: str):
         nonlocal step
         # load model
-        ckpt_model = torch.load(os.path.join(ckpt_path, 'model.pt'), map_location='cpu')
+        ckpt_model = torch.load(os.path.join(ckpt_path, 'model.pt'), map_location='cpu', mmap=True)
         model.load_state_dict(ckpt_model['model'])
         logger.info(f'Successfully load model from {ckpt_path}')
         # load optimizer
-        ckpt_optimizer = torch.load(os.path.join(ckpt_path, 'optimizer.pt'), map_location='cpu')
+        ckpt_optimizer = torch.load(os.path.join(ckpt_path, 'optimizer.pt'), map_location='cpu', mmap=True)
         optimizer.load_state_dict(ckpt_optimizer['optimizer'])
         logger.info(f'Successfully load optimizer from {ckpt_path}')
         # load meta information
-        ckpt_meta = torch.load(os.path.join(ckpt_path, 'meta.pt'), map_location='cpu')
+        ckpt_meta = torch.load(os.path.join(ckpt_path, 'meta.pt'), map_location='cpu', mmap=True)
         step = ckpt_meta['step'] + 1
 
+    save_thread = None
+
+    def _cpu_snapshot(obj):
+        if isinstance(obj, torch.Tensor):
+            return obj.detach().to('cpu', copy=True)
+        if isinstance(obj, dict):
+            return {k: _cpu_snapshot(v) for k, v in obj.items()}
+        if isinstance(obj, (tuple, list)):
+            return type(obj)(_cpu_snapshot(v) for v in obj)
+        return obj
+
     @accelerator.on_main_process
     def save_ckpt(save_path: str):
+        nonlocal save_thread
+        # only one save runs in the background at a time
+        if save_thread is not None:
+            save_thread.join()
         os.makedirs(save_path, exist_ok=True)
         unwrapped_model = accelerator.unwrap_model(model)
-        # save model
-        accelerator.save(dict(model=unwrapped_model.state_dict()), os.path.join(save_path, 'model.pt'))
-        # save optimizer
-        accelerator.save(dict(optimizer=optimizer.state_dict()), os.path.join(save_path, 'optimizer.pt'))
-        # save meta information
-        accelerator.save(dict(step=step), os.path.join(save_path, 'meta.pt'))
+        # unwrap_model keeps the torch.compile wrapper, whose state dict
+        # prefixes every key with '_orig_mod.'; strip it so checkpoints stay
+        # loadable by load_ckpt and sample.py, which use plain modules
+        unwrapped_model = getattr(unwrapped_model, '_orig_mod', unwrapped_model)
+        # snapshot states to cpu so training can keep mutating the originals
+        # while the files are written on a background thread
+        model_state = _cpu_snapshot(unwrapped_model.state_dict())
+        optimizer_state = _cpu_snapshot(optimizer.state_dict())
+        saved_step = step
+
+        def _write():
+            # save model
+            accelerator.save(dict(model=model_state), os.path.join(save_path, 'model.pt'))
+            # save optimizer
+            accelerator.save(dict(optimizer=optimizer_state), os.path.join(save_path, 'optimizer.pt'))
+            # save meta information
+            accelerator.save(dict(step=saved_step), os.path.join(save_path, 'meta.pt'))
+
+        save_thread = threading.Thread(target=_write, daemon=True)
+        save_thread.start()
 
     # RESUME TRAINING
     if args.resume is not None:
@@ -150,38 +229,80 @@ def main():
         load_ckpt(resume_path)
         logger.info(f'Restart training at step {step}')
 
+    # COMPILE MODEL
+    # compiled after (optionally) resuming so that checkpoints keep plain state dict keys;
+    # first step is slow due to compilation, subsequent steps benefit from kernel fusion
+    model = torch.compile(model, mode='reduce-overhead', fullgraph=False, dynamic=False)
+
     # PREPARE FOR DISTRIBUTED MODE AND MIXED PRECISION
-    model, optimizer, train_loader = accelerator.prepare(model, optimizer, train_loader)  # type: ignore
+    # batches stay on the host here; the prefetcher below moves them to the
+    # device on a side stream so the copy overlaps with the previous step
+    model, optimizer, train_loader = accelerator.prepare(
+        model, optimizer, train_loader, device_placement=[True, True, False],
+    )  # type: ignore
 
     accelerator.wait_for_everyone()
 
-    def _discard_labels(x):
-        return x[0] if isinstance(x, (tuple, list)) else x
+    # whether batches are (data, label) pairs is a property of the dataset,
+    # so probe it once instead of isinstance-checking in every step
+    if isinstance(train_set[0], (tuple, list)):
+        def _discard_labels(x):
+            return x[0]
+    else:
+        def _discard_labels(x):
+            return x
 
     def run_step(_batch):
-        x = _discard_labels(_batch).float()
-        idx = vqvae.get_latents(x)['indices']   # (B * H * W)
-        idx = idx.reshape(x.shape[0], -1)       # (B, H * W)
+        # the encoder and the transformer are separate reduce-overhead regions;
+        # marking the step boundary lets their CUDA graphs safely reuse static
+        # buffers across iterations
+        if device.type == 'cuda':
+            torch.compiler.cudagraph_mark_step_begin()
+        if use_cached_indices:
+            # cached indices stay int16 through the copy; they are widened on
+            # the device right before use
+            idx = _discard_labels(_batch).to(device, non_blocking=True)     # (B, H * W)
+        else:
+            x = _discard_labels(_batch).to(device, dtype=torch.float32, non_blocking=True)
+            with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=device.type == 'cuda'):
+                idx = vqvae.get_latents(x)['indices']   # (B * H * W)
+            # clone so that idx is no longer an inference tensor and can be saved
+            # for backward by the transformer's embedding lookup
+            idx = idx.reshape(x.shape[0], -1).clone()   # (B, H * W)
 
-        preds = model(idx)                      # (B, H * W + 1, C)
-        preds = preds[:, :-1, :]                # (B, H * W, C)
-        loss = F.cross_entropy(preds.reshape(-1, preds.shape[-1]), idx.reshape(-1))
+        with accelerator.accumulate(model):
+            # bf16 autocast keeps matmuls and softmax in half precision without
+            # needing gradient scaling; the backward pass runs outside the context
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=device.type == 'cuda'):
+                # codebook_num is far below 2**31, so the embedding lookup can
+                # take int32 indices (half the index bandwidth of int64); only
+                # the cross_entropy target has to be int64
+                preds = model(idx.to(torch.int32))  # (B, H * W + 1, C)
+                # cross_entropy accepts (B, C, L) logits with (B, L) targets;
+                # slice + transpose are views, so no copy is materialized
+                loss = F.cross_entropy(preds[:, :-1, :].transpose(1, 2), idx.long())
 
-        optimizer.zero_grad()
-        accelerator.backward(loss)
-        optimizer.step()
+            accelerator.backward(loss)
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
 
-        return dict(loss=loss.item(), lr=optimizer.param_groups[0]['lr'])
+        # return the loss as a detached tensor; StatusTracker resolves it
+        # lazily so no GPU sync happens here
+        return dict(loss=loss.detach(), lr=optimizer.param_groups[0]['lr'])
 
     @accelerator.on_main_process
-    @torch.no_grad()
+    @torch.inference_mode()
     def sample(savepath):
         unwrapped_model = accelerator.unwrap_model(model)
-        fm_size = conf.data.params.img_size // 4
-        idx = unwrapped_model.sample(B=64, L=fm_size ** 2, topk=100)
-        z = vqvae.codebook(idx).reshape(64, fm_size, fm_size, -1).permute(0, 3, 1, 2)
-        samples = vqvae.decode(z)
-        save_image(samples, savepath, nrow=8, normalize=True, value_range=(-1, 1))
+        if use_cached_indices:
+            fm_size = int(train_set[0].shape[0] ** 0.5)
+        else:
+            fm_size = conf.data.params.img_size // 4
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=device.type == 'cuda'):
+            idx = unwrapped_model.sample(B=64, L=fm_size ** 2, topk=100)
+            z = vqvae.codebook(idx).reshape(64, fm_size, fm_size, -1).permute(0, 3, 1, 2)
+            samples = vqvae.decode(z)
+        save_image(samples.float(), savepath, nrow=8, normalize=True, value_range=(-1, 1))
 
     # START TRAINING
     logger.info('Start training...')
@@ -189,6 +310,9 @@ def main():
         dataloader=train_loader,
         tqdm_kwargs=dict(desc='Epoch', leave=False, disable=not accelerator.is_main_process),
     )
+    train_data_generator = ThreadDataPrefetcher(train_data_generator)
+    if device.type == 'cuda':
+        train_data_generator = CudaDataPrefetcher(train_data_generator, device)
     while step < conf.train.n_steps:
         # get a batch of data
         batch = next(train_data_generator)
@@ -196,7 +320,8 @@ def main():
         model.train()
         train_status = run_step(batch)
         status_tracker.track_status('Train', train_status, step)
-        accelerator.wait_for_everyone()
+        # no barrier here: DDP gradient all-reduce already keeps processes in
+        # lockstep, so an explicit per-step synchronization only adds latency
 
         model.eval()
         # save checkpoint
@@ -204,13 +329,18 @@ def main():
             save_ckpt(os.path.join(exp_dir, 'ckpt', f'step{step:0>6d}'))
             accelerator.wait_for_everyone()
         # sample from current model
+        # no barrier afterwards: sampling only runs on the main process and
+        # touches no shared state, so other processes may proceed to the next
+        # step and will meet the main process at its gradient all-reduce
         if check_freq(conf.train.sample_freq, step):
             sample(os.path.join(exp_dir, 'samples', f'step{step:0>6d}.png'))
-            accelerator.wait_for_everyone()
         step += 1
     # save the last checkpoint if not saved
     if not check_freq(conf.train.save_freq, step - 1):
         save_ckpt(os.path.join(exp_dir, 'ckpt', f'step{step-1:0>6d}'))
+    # make sure the last background save finished before exiting
+    if save_thread is not None:
+        save_thread.join()
     accelerator.wait_for_everyone()
     status_tracker.close()
     logger.info('End of training')
@@ -116,15 +116,15 @@ def main():
     def load_ckpt(ckpt_path: str):
         nonlocal step
         # load model
-        ckpt_model = torch.load(os.path.join(ckpt_path, 'model.pt'), map_location='cpu')
+        ckpt_model = torch.load(os.path.join(ckpt_path, 'model.pt'), map_location='cpu', mmap=True)
         model.load_state_dict(ckpt_model['model'])
         logger.info(f'Successfully load model from {ckpt_path}')
         # load optimizer
-        ckpt_optimizer = torch.load(os.path.join(ckpt_path, 'optimizer.pt'), map_location='cpu')
+        ckpt_optimizer = torch.load(os.path.join(ckpt_path, 'optimizer.pt'), map_location='cpu', mmap=True)
         optimizer.load_state_dict(ckpt_optimizer['optimizer'])
         logger.info(f'Successfully load optimizer from {ckpt_path}')
         # load meta information
-        ckpt_meta = torch.load(os.path.join(ckpt_path, 'meta.pt'), map_location='cpu')
+        ckpt_meta = torch.load(os.path.join(ckpt_path, 'meta.pt'), map_location='cpu', mmap=True)
         step = ckpt_meta['step'] + 1
 
     @accelerator.on_main_process
@@ -181,11 +181,13 @@ def main():
             unwrapped_model = accelerator.unwrap_model(model)
             unwrapped_model.update_codebook(new_sumz, new_sumn)
 
+        # losses are returned as detached tensors; StatusTracker resolves them
+        # lazily so no GPU sync happens here
         return dict(
-            loss_rec=loss_rec.item(),
-            loss_vq=loss_vq.item(),
-            loss_commit=loss_commit.item(),
-            perplexity=out['perplexity'].item(),
+            loss_rec=loss_rec.detach(),
+            loss_vq=loss_vq.detach(),
+            loss_commit=loss_commit.detach(),
+            perplexity=out['perplexity'].detach(),
             lr=optimizer.param_groups[0]['lr'],
         )
 
@@ -60,24 +60,35 @@ class StatusTracker:
     ):
         self.logger = logger
         self.print_freq = print_freq
+        self.buffer = []
         self.tb_writer = None
         if is_main_process:
             self.tb_writer = get_tb_writer(log_dir=os.path.join(exp_dir, 'tensorboard'))
 
     def close(self):
+        self.flush()
         if self.tb_writer is not None:
             self.tb_writer.close()
 
     def track_status(self, name: str, status: Dict, step: int, write_tb: List[bool] = None):
-        message = f'[{name}] step: {step}'
-        for i, (k, v) in enumerate(status.items()):
-            if isinstance(v, Tensor):
-                v = v.item()
-            message += f', {k}: {v:.6f}'
-            if self.tb_writer is not None and (write_tb is None or write_tb[i] is True):
-                self.tb_writer.add_scalar(f'{name}/{k}', v, step)
-        if self.print_freq > 0 and (step + 1) % self.print_freq == 0:
-            self.logger.info(message)
+        # tensor values are kept as-is and only resolved in flush(), so that
+        # tracking a status does not force a GPU synchronization every step
+        self.buffer.append((name, status, step, write_tb))
+        if self.print_freq <= 0 or (step + 1) % self.print_freq == 0:
+            self.flush()
+
+    def flush(self):
+        for name, status, step, write_tb in self.buffer:
+            message = f'[{name}] step: {step}'
+            for i, (k, v) in enumerate(status.items()):
+                if isinstance(v, Tensor):
+                    v = v.item()
+                message += f', {k}: {v:.6f}'
+                if self.tb_writer is not None and (write_tb is None or write_tb[i] is True):
+                    self.tb_writer.add_scalar(f'{name}/{k}', v, step)
+            if self.print_freq > 0 and (step + 1) % self.print_freq == 0:
+                self.logger.info(message)
+        self.buffer.clear()
 
 
 def get_tb_writer(log_dir):
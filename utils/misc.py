@@ -2,9 +2,11 @@ import os
 import sys
 import tqdm
 import torch
+import queue
 import shutil
 import datetime
 import importlib
+import threading
 
 
 def check_freq(freq: int, step: int):
@@ -49,6 +51,74 @@ def get_data_generator(dataloader, tqdm_kwargs):
             yield batch
 
 
+class ThreadDataPrefetcher:
+    """ Decouple data loading from the training loop with a background thread.
+
+    A daemon thread keeps pulling batches from the data generator into a
+    bounded queue, so dataloader bookkeeping and collation overlap with the
+    training step instead of running on its critical path. Exceptions raised
+    by the generator are forwarded to the consumer.
+    """
+    def __init__(self, data_generator, max_prefetch: int = 2):
+        self.queue = queue.Queue(maxsize=max_prefetch)
+        self.thread = threading.Thread(target=self._worker, args=(data_generator,), daemon=True)
+        self.thread.start()
+
+    def _worker(self, data_generator):
+        try:
+            while True:
+                self.queue.put(next(data_generator))
+        except BaseException as e:  # noqa
+            self.queue.put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = self.queue.get()
+        if isinstance(batch, BaseException):
+            raise batch
+        return batch
+
+
+class CudaDataPrefetcher:
+    """ Prefetch batches from a data generator onto a CUDA device.
+
+    While the current batch is being consumed, the next one is copied to the
+    device with non-blocking transfers on a side stream, so the host-to-device
+    copy overlaps with compute. Batches should come from pinned host memory
+    for the copies to actually be asynchronous.
+    """
+    def __init__(self, data_generator, device):
+        self.data_generator = data_generator
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+        self.next_batch = None
+        self._preload()
+
+    def _apply(self, batch, fn):
+        if isinstance(batch, (tuple, list)):
+            return type(batch)(self._apply(b, fn) for b in batch)
+        return fn(batch) if isinstance(batch, torch.Tensor) else batch
+
+    def _preload(self):
+        batch = next(self.data_generator)
+        with torch.cuda.stream(self.stream):
+            self.next_batch = self._apply(batch, lambda t: t.to(self.device, non_blocking=True))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self.stream)
+        batch = self.next_batch
+        # keep the copy-stream memory alive until the current stream is done with it
+        self._apply(batch, lambda t: t.record_stream(current_stream) or t)
+        self._preload()
+        return batch
+
+
 def find_resume_checkpoint(exp_dir: str, resume: str):
     """ Checkpoints are named after 'stepxxxxxx/' """
     if os.path.isdir(resume):